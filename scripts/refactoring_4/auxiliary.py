@@ -76,21 +76,9 @@ def horizon(network, parameters, frequencyvector, detSNR, T, fmax):
 
 
 def scalar_product(deriv1, deriv2, detector):
-    components = detector.components
-    ff = detector.frequencyvector
-
     if deriv1.ndim == 1:
         deriv1 = deriv1[:, np.newaxis]
         deriv2 = deriv2[:, np.newaxis]
 
-    if ff.ndim == 1:
-        ff = ff[:, np.newaxis]
-
-    df = ff[1, 0] - ff[0, 0]
-
-    scalar_prods = np.zeros(len(components))
-    for k in np.arange(len(components)):
-        scalar_prods[k] = 4 * df * np.sum(
-            np.real(deriv1[:, k] * np.conjugate(deriv2[:, k])) / components[k].Sn(ff[:, 0]), axis=0)
-
-    return scalar_prods
+    # real part of deriv1 * conj(deriv2), without forming the complex product
+    return np.sum((deriv1.real * deriv2.real + deriv1.imag * deriv2.imag) * detector.psd_weights, axis=0)
@@ -3,6 +3,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 import yaml
 from pathlib import Path
+from functools import cached_property
 
 import constants as cst
 
@@ -116,6 +117,8 @@ class Detector:
         else:
             nd = 1
 
+        # always 3D, with shape (n_signals, n_fisher_parameters, n_fisher_parameters):
+        # fisher_matrix[k] is the 2D matrix of signal k, no squeezing needed
         self.fisher_matrix = np.zeros((len(parameters), nd, nd))
         self.name = name
         self.config = config
@@ -172,6 +175,20 @@ class Detector:
         else:
             self.components.append(DetectorComponent(name=name, component=0, detector_def=detector_def, plot=plot))
 
+    @cached_property
+    def psd_weights(self):
+        # 4 df / Sn for each frequency and component, shape (nf, n_components):
+        # the weights of the noise-weighted scalar product, computed on first use
+        ff = self.frequencyvector[:, 0]
+        df = ff[1] - ff[0]
+        return 4 * df / np.stack([component.Sn(ff) for component in self.components], axis=1)
+
+    @cached_property
+    def i_omega(self):
+        # 2j pi f, shape (nf, 1): the derivative of the signal with respect to
+        # geocent_time is i_omega times the signal, and its phase factor is exp(i_omega tc)
+        return 2j * np.pi * self.frequencyvector
+
 
 class Network:
 
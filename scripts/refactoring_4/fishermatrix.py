@@ -1,80 +1,181 @@
 """Reformatted, typed code.
 """
+import os
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
 import numpy as np
 import pandas as pd
+from scipy.linalg.blas import dsyrk
 
 import waveforms as wf
 import detection as det
 import auxiliary as aux
 
+SINGULAR_VALUE_THRESHOLD = 1e-10
+
+
+def _normalize(matrices):
+    """
+    Normalize the rows and columns of a matrix, or of a stack of matrices,
+    by the square root of the diagonal.
+    Returns the normalized copy and the inverse square roots of the diagonal.
+    """
+    # two broadcast products, without building their outer product
+    inv_dm = 1.0 / np.sqrt(matrices.diagonal(0, -2, -1))
+    matrices_norm = matrices * inv_dm[..., :, np.newaxis]
+    matrices_norm *= inv_dm[..., np.newaxis, :]
+    return matrices_norm, inv_dm
+
+
+def _rescale(matrices_norm, inv_dm):
+    """
+    Undo the normalization of _normalize on the inverse, in place.
+    """
+    matrices_norm *= inv_dm[..., :, np.newaxis]
+    matrices_norm *= inv_dm[..., np.newaxis, :]
+    return matrices_norm
+
+
+def _invert_2x2(matrices_norm):
+    """
+    Closed-form inverses of a stack of normalized 2x2 matrices, together with
+    the mask of those whose smallest eigenvalue is not above the threshold,
+    which are left for the truncated inverse.
+    """
+    a = matrices_norm[:, 0, 0]
+    b = matrices_norm[:, 0, 1]
+    c = matrices_norm[:, 1, 1]
+    determinant = a * c - b * b
+
+    # the determinant is the product of the two eigenvalues
+    largest_eigenvalue = 0.5 * (a + c) + np.hypot(0.5 * (a - c), b)
+    singular = ~(determinant > SINGULAR_VALUE_THRESHOLD * largest_eigenvalue)
+
+    inverses_norm = np.empty_like(matrices_norm)
+    inverses_norm[:, 0, 0] = c
+    inverses_norm[:, 1, 1] = a
+    inverses_norm[:, 0, 1] = -b
+    inverses_norm[:, 1, 0] = -b
+    np.divide(
+        inverses_norm,
+        determinant[:, np.newaxis, np.newaxis],
+        out=inverses_norm,
+        where=~singular[:, np.newaxis, np.newaxis],
+    )
+
+    return inverses_norm, singular
+
 
 def invertSVD(matrix):
-    thresh = 1e-10
+    # a stack of one, so that there is a single implementation of the truncated inverse
+    return invert_fisher_matrices(matrix[np.newaxis])[0]
 
-    dm = np.sqrt(np.diag(matrix))
-    normalizer = np.outer(dm, dm)
-    matrix_norm = matrix / normalizer
 
-    [U, S, Vh] = np.linalg.svd(matrix_norm)
+def invert_fisher_matrices(matrices: np.ndarray) -> np.ndarray:
+    """
+    Invert a stack of Fisher matrices with shape (n_matrices, n_params, n_params)
+    with a single batched call.
 
-    kVal = sum(S > thresh)
-    matrix_inverse_norm = U[:, 0:kVal] @ np.diag(1.0 / S[0:kVal]) @ Vh[0:kVal, :]
+    The matrices are normalized by the square root of their diagonal, and those
+    which are singular to working precision are pseudo-inverted, discarding
+    the singular values below SINGULAR_VALUE_THRESHOLD, also batched.
+    """
+    matrices_norm, inv_dm = _normalize(matrices)
+
+    if matrices.shape[-1] == 2:
+        # two parameters (e.g., a sky-only analysis): no LAPACK call is needed
+        inverses_norm, singular = _invert_2x2(matrices_norm)
+    else:
+        try:
+            inverses_norm = np.linalg.inv(matrices_norm)
+        except np.linalg.LinAlgError:
+            inverses_norm = np.full_like(matrices_norm, np.inf)
+
+        # the Frobenius norm of the inverse bounds the inverse of the smallest
+        # singular value, so below 1/threshold the truncation would discard nothing
+        singular = ~(
+            np.linalg.norm(inverses_norm, axis=(1, 2)) < 1 / SINGULAR_VALUE_THRESHOLD
+        )
 
-    return matrix_inverse_norm / normalizer
+    if np.any(singular):
+        # the matrices are symmetric, so their singular values are the moduli
+        # of their eigenvalues: eigh gives the same truncation as an SVD,
+        # without computing two sets of singular vectors
+        eigenvalues, eigenvectors = np.linalg.eigh(matrices_norm[singular])
+        eigenvalues_inv = np.divide(
+            1.0,
+            eigenvalues,
+            out=np.zeros_like(eigenvalues),
+            where=np.abs(eigenvalues) > SINGULAR_VALUE_THRESHOLD,
+        )
+        inverses_norm[singular] = (
+            eigenvectors * eigenvalues_inv[:, np.newaxis, :]
+        ) @ eigenvectors.swapaxes(1, 2)
 
+    return _rescale(inverses_norm, inv_dm)
 
-def derivative(waveform, parameter_values, p, detector):
+
+def waveform_projection(waveform, parameter_values, detector):
+    """
+    Returns the polarizations, t_of_f and the projection onto the detector
+    of the waveform at parameter_values.
+    """
+    wave, t_of_f = wf.hphc_amplitudes(
+        waveform, parameter_values, detector.frequencyvector
+    )
+    return wave, t_of_f, det.projection(parameter_values, detector, wave, t_of_f)
+
+
+def derivative(
+    waveform, parameter_values, p, detector, base_projection=None, phase_tc=None
+):
 
     """
     Calculates derivatives with respect to geocent_time, merger phase, and distance analytically.
     Derivatives of other parameters are calculated numerically.
+
+    The polarizations, t_of_f and projection at parameter_values can be passed
+    as base_projection, and the phase factor exp(2j pi f tc) as phase_tc,
+    so that they are not recomputed for each parameter.
     """
 
-    local_params = parameter_values.copy()
+    # plain dictionaries are much cheaper to copy than pandas Series
+    local_params = dict(parameter_values)
 
     tc = local_params["geocent_time"]
 
+    # the analytic derivatives and the ones with respect to the sky angles
+    # only need the waveform at parameter_values
+    if base_projection is None and p in [
+        "luminosity_distance",
+        "geocent_time",
+        "phase",
+        "ra",
+        "dec",
+        "psi",
+    ]:
+        base_projection = waveform_projection(waveform, local_params, detector)
+
     if p == "luminosity_distance":
-        wave, t_of_f = wf.hphc_amplitudes(
-            waveform, local_params, detector.frequencyvector
-        )
-        derivative = (
-            -1.0
-            / local_params[p]
-            * det.projection(local_params, detector, wave, t_of_f)
-        )
+        derivative = -1.0 / local_params[p] * base_projection[2]
     elif p == "geocent_time":
-        wave, t_of_f = wf.hphc_amplitudes(
-            waveform, local_params, detector.frequencyvector
-        )
-        derivative = (
-            2j
-            * np.pi
-            * detector.frequencyvector
-            * det.projection(local_params, detector, wave, t_of_f)
-        )
+        derivative = detector.i_omega * base_projection[2]
     elif p == "phase":
-        wave, t_of_f = wf.hphc_amplitudes(
-            waveform, local_params, detector.frequencyvector
-        )
-        derivative = -1j * det.projection(local_params, detector, wave, t_of_f)
+        derivative = -1j * base_projection[2]
     else:
         pv = local_params[p]
         eps = 1e-5  # this follows the simple "cube root of numerical precision" recommendation, which is 1e-16 for double
         dp = np.maximum(eps, eps * pv)
 
-        pv_set1 = parameter_values.copy()
-        pv_set2 = parameter_values.copy()
+        pv_set1 = local_params.copy()
+        pv_set2 = local_params.copy()
 
         pv_set1[p] = pv - dp / 2.0
         pv_set2[p] = pv + dp / 2.0
 
         if p in ["ra", "dec", "psi"]:  # these parameters do not influence the waveform
-            wave, t_of_f = wf.hphc_amplitudes(
-                waveform, local_params, detector.frequencyvector
-            )
+            wave, t_of_f, _ = base_projection
 
             signal1 = det.projection(pv_set1, detector, wave, t_of_f)
             signal2 = det.projection(pv_set2, detector, wave, t_of_f)
@@ -94,14 +195,25 @@ def derivative(waveform, parameter_values, p, detector):
 
             pv_set1["geocent_time"] = tc
             pv_set2["geocent_time"] = tc
-            signal1 = det.projection(pv_set1, detector, wave1, t_of_f1 + tc)
-            signal2 = det.projection(pv_set2, detector, wave2, t_of_f2 + tc)
-
-            derivative = (
-                np.exp(2j * np.pi * detector.frequencyvector * tc)
-                * (signal2 - signal1)
-                / dp
-            )
+            if np.array_equal(t_of_f1, t_of_f2):
+                # p does not enter t(f) (e.g., theta_jn), so both waveforms see the
+                # same antenna patterns: since the projection is linear in the
+                # polarizations, their difference only needs to be projected once
+                signal_difference = det.projection(
+                    local_params, detector, wave2 - wave1, t_of_f1 + tc
+                )
+            else:
+                signal1 = det.projection(pv_set1, detector, wave1, t_of_f1 + tc)
+                signal2 = det.projection(pv_set2, detector, wave2, t_of_f2 + tc)
+                signal_difference = np.subtract(signal2, signal1, out=signal2)
+
+            if phase_tc is None:
+                phase_tc = np.exp(detector.i_omega * tc)
+
+            # the difference is a fresh array, so it can be scaled in place
+            signal_difference *= phase_tc
+            signal_difference /= dp
+            derivative = signal_difference
 
     # print(fisher_parameters[p] + ': ' + str(derivative))
     return derivative
@@ -110,20 +222,35 @@ def derivative(waveform, parameter_values, p, detector):
 def FisherMatrix(waveform, parameter_values, fisher_parameters, detector):
 
     nd = len(fisher_parameters)
-    fm = np.zeros((nd, nd))
 
-    for p1 in range(nd):
-        deriv1_p = fisher_parameters[p1]
-        deriv1 = derivative(waveform, parameter_values, deriv1_p, detector)
-        # sum Fisher matrices from different components of same detector (e.g., in the case of ET)
-        fm[p1, p1] = np.sum(aux.scalar_product(deriv1, deriv1, detector), axis=0)
-        for p2 in range(p1 + 1, nd):
-            deriv2_p = fisher_parameters[p2]
-            deriv2 = derivative(waveform, parameter_values, deriv2_p, detector)
-            fm[p1, p2] = np.sum(aux.scalar_product(deriv1, deriv2, detector), axis=0)
-            fm[p2, p1] = fm[p1, p2]
+    parameter_values = dict(parameter_values)
 
-    return fm
+    # computed once, and shared by all the derivatives which need them
+    base_projection = waveform_projection(waveform, parameter_values, detector)
+    phase_tc = np.exp(detector.i_omega * parameter_values["geocent_time"])
+
+    # shape (nd, nf, n_components)
+    derivs = np.stack(
+        [
+            derivative(
+                waveform, parameter_values, p, detector, base_projection, phase_tc
+            )
+            for p in fisher_parameters
+        ]
+    )
+
+    # with D the derivatives weighted by sqrt(4 df / Sn), summed over frequencies
+    # and over the components of the same detector (e.g., in the case of ET),
+    # the Fisher matrix is Re(D D^H) = R R^T, where the rows of R hold the real
+    # and imaginary parts of D: a float view of the complex array, without copies
+    weighted_derivs = derivs * np.sqrt(detector.psd_weights)
+    real_derivs = weighted_derivs.reshape(nd, -1).view(np.float64)
+
+    # a single BLAS call, which only fills the upper triangle;
+    # the transpose is Fortran-ordered, so it is not copied
+    fm = dsyrk(1.0, real_derivs.T, trans=1)
+
+    return np.triu(fm) + np.triu(fm, 1).T
 
 
 def sky_localization_area(
@@ -131,18 +258,22 @@ def sky_localization_area(
     declination_angle: np.ndarray,
     right_ascension_index: int,
     declination_index: int,
-) -> float:
+) -> np.ndarray:
     """
     Compute the 1-sigma sky localization ellipse area starting
     from the full network Fisher matrix inverse and the inclination.
+
+    Also works on a stack of inverses with shape (n_signals, n_params, n_params)
+    and declinations with shape (n_signals,), returning one area per signal.
     """
     return (
         np.pi
         * np.abs(np.cos(declination_angle))
         * np.sqrt(
-            network_fisher_inverse[right_ascension_index, right_ascension_index]
-            * network_fisher_inverse[declination_index, declination_index]
-            - network_fisher_inverse[right_ascension_index, declination_index] ** 2
+            network_fisher_inverse[..., right_ascension_index, right_ascension_index]
+            * network_fisher_inverse[..., declination_index, declination_index]
+            - network_fisher_inverse[..., right_ascension_index, declination_index]
+            ** 2
         )
     )
 
@@ -152,13 +283,18 @@ def compute_fisher_errors(
     parameter_values: pd.DataFrame,
     fisher_parameters: list[str],
     sub_network_ids: list[int],
-) -> tuple[np.ndarray, np.ndarray, Optional[np.ndarray]]:
+    n_workers: Optional[int] = None,
+) -> tuple[np.ndarray, np.ndarray, Optional[np.ndarray], np.ndarray]:
     """
     Compute Fisher matrix errors for a network whose
     SNR and Fisher matrices have already been calculated.
 
     Will only return output for the signals n_above_thr
-    for which the network SNR is above network.detection_SNR[1].
+    for which the network SNR is above network.detection_SNR[1]
+    and at least one detector SNR is above network.detection_SNR[0].
+
+    The inversions are split among n_workers threads
+    (by default, one per CPU).
 
     Returns:
     network_snr: array with shape (n_above_thr,)
@@ -169,6 +305,8 @@ def compute_fisher_errors(
         One-sigma sky localization area in steradians,
         returned if the signals have both right ascension and declination,
         None otherwise.
+    detected: array with shape (n_above_thr,)
+        Indices of the detected signals in parameter_values.
     """
 
     n_params = len(fisher_parameters)
@@ -185,40 +323,53 @@ def compute_fisher_errors(
 
     detector_snr_thr, network_snr_thr = network.detection_SNR
 
-    parameter_errors = np.zeros((n_signals, n_params))
-    if signals_havesky:
-        sky_localization = np.zeros((n_signals,))
-    network_snr = np.zeros((n_signals,))
-
     detectors = [network.detectors[d] for d in sub_network_ids]
 
-    network_snr = np.sqrt(sum((detector.SNR**2 for detector in detectors)))
-
-    for k in range(n_signals):
-        network_fisher_matrix = np.zeros((n_params, n_params))
-
-        for detector in detectors:
-            if detector.SNR[k] > detector_snr_thr:
-                network_fisher_matrix += detector.fisher_matrix[k, :, :]
-
-        network_fisher_inverse = invertSVD(network_fisher_matrix)
-        parameter_errors[k, :] = np.sqrt(np.diagonal(network_fisher_inverse))
+    snrs = np.stack([detector.SNR for detector in detectors])
+    network_snr = np.linalg.norm(snrs, axis=0)
+
+    # a signal can pass the network threshold with every detector below its own:
+    # its network Fisher matrix would then be all zeros, and it cannot be inverted
+    detected = np.where(
+        (network_snr > network_snr_thr) & np.any(snrs > detector_snr_thr, axis=0)
+    )[0]
+
+    # only the detected signals are accumulated and inverted, one detector
+    # at a time rather than stacking all of their matrices;
+    # each detector contributes where its own SNR is above threshold
+    network_fisher_matrices = np.zeros((len(detected), n_params, n_params))
+    for detector in detectors:
+        above_thr = detector.SNR[detected] > detector_snr_thr
+        np.add(
+            network_fisher_matrices,
+            detector.fisher_matrix[detected],
+            out=network_fisher_matrices,
+            where=above_thr[:, np.newaxis, np.newaxis],
+        )
 
-        if signals_havesky:
-            sky_localization[k] = sky_localization_area(
-                network_fisher_inverse, parameter_values["dec"].iloc[k], i_ra, i_dec
-            )
+    # the signals are independent, and numpy releases the GIL
+    # in its linear algebra routines, so threads are enough
+    n_workers = n_workers or os.cpu_count() or 1
+    chunks = np.array_split(
+        network_fisher_matrices, max(1, min(n_workers, len(detected)))
+    )
+    with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+        network_fisher_inverse = np.concatenate(
+            list(executor.map(invert_fisher_matrices, chunks))
+        )
+    parameter_errors = np.sqrt(np.einsum("kii->ki", network_fisher_inverse))
 
-    detected = np.where(network_snr > network_snr_thr)[0]
+    if not signals_havesky:
+        return network_snr[detected], parameter_errors, None, detected
 
-    if signals_havesky:
-        return (
-            network_snr[detected],
-            parameter_errors[detected, :],
-            sky_localization[detected],
-        )
+    sky_localization = sky_localization_area(
+        network_fisher_inverse,
+        parameter_values["dec"].to_numpy()[detected],
+        i_ra,
+        i_dec,
+    )
 
-    return network_snr[detected], parameter_errors[detected, :], None
+    return network_snr[detected], parameter_errors, sky_localization, detected
 
 
 def output_to_txt_file(
@@ -231,27 +382,25 @@ def output_to_txt_file(
 ) -> None:
 
     delim = " "
-    header = (
-        "network_SNR "
-        + delim.join(parameter_values.keys())
-        + " "
-        + delim.join(["err_" + x for x in fisher_parameters])
-    )
-    save_data = np.c_[network_snr, parameter_values, parameter_errors]
+
+    # numeric parameters are written as floats, string ones (e.g., id) as they are;
+    # the network SNR is written in full
+    columns = [
+        pd.Series(network_snr, dtype=float, name="network_SNR").astype(str),
+        parameter_values.reset_index(drop=True).astype(
+            {column: float for column in parameter_values.select_dtypes("number")}
+        ),
+        pd.DataFrame(
+            parameter_errors, columns=["err_" + x for x in fisher_parameters]
+        ),
+    ]
     if sky_localization is not None:
-        header += " err_sky_location"
-        save_data = np.c_[save_data, sky_localization]
-
-    row_format = "%s " + " ".join(["%.3E" for _ in range(save_data.shape[1] - 1)])
-
-    np.savetxt(
-        filename + ".txt",
-        save_data,
-        delimiter=" ",
-        header=header,
-        comments="",
-        fmt=row_format,
-    )
+        columns.append(pd.Series(sky_localization, name="err_sky_location"))
+
+    output = pd.concat(columns, axis=1)
+
+    # pandas formats whole columns at once, instead of formatting each row in Python
+    output.to_csv(filename + ".txt", sep=delim, float_format="%.3E", index=False)
 
 
 def errors_file_name(
@@ -276,15 +425,17 @@ def analyze_and_save_to_txt(
     fisher_parameters: list[str],
     sub_network_ids_list: list[list[int]],
     population_name: str,
+    n_workers: Optional[int] = None,
 ) -> None:
 
     for sub_network_ids in sub_network_ids_list:
 
-        network_snr, errors, sky_localization = compute_fisher_errors(
+        network_snr, errors, sky_localization, detected = compute_fisher_errors(
             network=network,
             parameter_values=parameter_values,
             fisher_parameters=fisher_parameters,
             sub_network_ids=sub_network_ids,
+            n_workers=n_workers,
         )
 
         filename = errors_file_name(
@@ -294,7 +445,7 @@ def analyze_and_save_to_txt(
         )
 
         output_to_txt_file(
-            parameter_values=parameter_values,
+            parameter_values=parameter_values.iloc[detected],
             network_snr=network_snr,
             parameter_errors=errors,
             sky_localization=sky_localization,
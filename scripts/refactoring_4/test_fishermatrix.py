@@ -1,11 +1,42 @@
+import pytest
 from fishermatrix import analyze_and_save_to_txt
 import fishermatrix
+import auxiliary as aux
 import waveforms
 from detection import Network
 import pandas as pd
 import numpy as np
 
 
+GW170817 = {
+    "mass_1": 1.4,
+    "mass_2": 1.4,
+    "redshift": 0.01,
+    "luminosity_distance": 40,
+    "theta_jn": 5 / 6 * np.pi,
+    "ra": 3.45,
+    "dec": -0.41,
+    "psi": 1.6,
+    "phase": 0,
+    "geocent_time": 1187008882,
+}
+
+
+@pytest.fixture
+def gw170817_network():
+    parameter_values = pd.DataFrame({key: [item] for key, item in GW170817.items()})
+    fisher_parameters = list(GW170817.keys())
+
+    network = Network(
+        detector_ids=["ET"],
+        parameters=parameter_values,
+        fisher_parameters=fisher_parameters,
+        config="detectors.yaml",
+    )
+
+    return parameter_values, fisher_parameters, network
+
+
 def test_fisher_analysis_output(mocker):
     params = {
         "mass_1": 1.4,
@@ -42,7 +73,7 @@ def test_fisher_analysis_output(mocker):
 
     network.detectors[0].SNR[0] = 100
 
-    mocker.patch("numpy.savetxt")
+    mocker.patch.object(pd.DataFrame, "to_csv", autospec=True)
 
     analyze_and_save_to_txt(
         network=network,
@@ -84,17 +115,17 @@ def test_fisher_analysis_output(mocker):
         2.42285325663e-05,
     ]
 
-    assert np.savetxt.call_args.args[0] == "Errors_ET_test_SNR8.0.txt"
-    assert np.allclose(np.savetxt.call_args.args[1], data)
+    output, filename = pd.DataFrame.to_csv.call_args.args
 
-    assert np.savetxt.call_args.kwargs == {
-        "delimiter": " ",
-        "header": header,
-        "comments": "",
-        "fmt": (
-            "%s %.3E %.3E %.3E %.3E %.3E %.3E %.3E %.3E %.3E %.3E "
-            "%.3E %.3E %.3E %.3E %.3E %.3E %.3E %.3E %.3E %.3E %.3E"
-        ),
+    assert filename == "Errors_ET_test_SNR8.0.txt"
+    assert " ".join(output.columns) == header
+    assert output["network_SNR"].tolist() == ["100.0"]
+    assert np.allclose(output.to_numpy(dtype=float), data)
+
+    assert pd.DataFrame.to_csv.call_args.kwargs == {
+        "sep": " ",
+        "float_format": "%.3E",
+        "index": False,
     }
 
 def test_fisher_analysis_output_nosky(mocker):
@@ -134,7 +165,7 @@ def test_fisher_analysis_output_nosky(mocker):
 
     network.detectors[0].SNR[0] = 100
 
-    mocker.patch("numpy.savetxt")
+    mocker.patch.object(pd.DataFrame, "to_csv", autospec=True)
 
     analyze_and_save_to_txt(
         network=network,
@@ -174,15 +205,270 @@ def test_fisher_analysis_output_nosky(mocker):
         2.251E-05,
     ]
 
-    assert np.savetxt.call_args.args[0] == "Errors_ET_test_SNR8.0.txt"
-    assert np.allclose(np.savetxt.call_args.args[1], data, rtol=2e-3)
+    output, filename = pd.DataFrame.to_csv.call_args.args
+
+    assert filename == "Errors_ET_test_SNR8.0.txt"
+    assert " ".join(output.columns) == header
+    assert np.allclose(output.to_numpy(dtype=float), data, rtol=2e-3)
+
+    assert pd.DataFrame.to_csv.call_args.kwargs == {
+        "sep": " ",
+        "float_format": "%.3E",
+        "index": False,
+    }
+
+@pytest.mark.parametrize("dimension, rank", [(6, 6), (6, 4), (2, 2), (2, 1)])
+def test_invert_svd(dimension, rank):
+    rng = np.random.default_rng(1)
+    vectors = rng.normal(size=(rank, dimension)) * np.logspace(-3, 3, dimension)
+    matrix = vectors.T @ vectors
+
+    inverse = fishermatrix.invertSVD(matrix)
+
+    assert np.allclose(inverse, inverse.T)
+    assert np.allclose(matrix @ inverse @ matrix, matrix)
+    assert np.allclose(inverse @ matrix @ inverse, inverse)
+    if rank == dimension:
+        assert np.allclose(inverse, np.linalg.inv(matrix))
+
+
+@pytest.mark.parametrize(
+    "dimension, ranks", [(6, [6, 4, 6, 5]), (2, [2, 1, 2, 1])]
+)
+def test_invert_fisher_matrices(dimension, ranks):
+    rng = np.random.default_rng(1)
+    matrices = []
+    for rank in ranks:
+        vectors = rng.normal(size=(rank, dimension)) * np.logspace(-3, 3, dimension)
+        matrices.append(vectors.T @ vectors)
+    matrices = np.stack(matrices)
+
+    inverses = fishermatrix.invert_fisher_matrices(matrices)
+
+    assert inverses.shape == matrices.shape
+    for matrix, inverse, rank in zip(matrices, inverses, ranks):
+        assert np.allclose(matrix @ inverse @ matrix, matrix)
+        assert np.allclose(inverse @ matrix @ inverse, inverse)
+        if rank == dimension:
+            assert np.allclose(inverse, np.linalg.inv(matrix))
+
+
+def test_sky_localization_area_stack():
+    rng = np.random.default_rng(1)
+    vectors = rng.normal(size=(3, 6, 6))
+    inverses = vectors @ vectors.transpose(0, 2, 1)
+    declinations = np.array([-0.41, 0.0, 1.2])
+
+    areas = fishermatrix.sky_localization_area(inverses, declinations, 1, 2)
+
+    assert areas.shape == (3,)
+    for area, inverse, declination in zip(areas, inverses, declinations):
+        assert area == fishermatrix.sky_localization_area(inverse, declination, 1, 2)
+
+
+@pytest.mark.parametrize("n_workers", [1, 3])
+def test_compute_fisher_errors_workers(n_workers):
+    rng = np.random.default_rng(1)
+    n_signals = 5
+    vectors = rng.normal(size=(n_signals, 6, 6))
 
-    assert np.savetxt.call_args.kwargs == {
-        "delimiter": " ",
-        "header": header,
-        "comments": "",
-        "fmt": (
-            "%s %.3E %.3E %.3E %.3E %.3E %.3E %.3E %.3E %.3E %.3E "
-            "%.3E %.3E %.3E %.3E %.3E %.3E %.3E %.3E %.3E"
+    parameter_values = pd.DataFrame({"dec": rng.uniform(-1, 1, n_signals)})
+    network = Network(
+        detector_ids=["ET"],
+        parameters=parameter_values,
+        fisher_parameters=["ra", "dec", "a", "b", "c", "d"],
+        config="detectors.yaml",
+    )
+    network.detectors[0].fisher_matrix[:] = vectors @ vectors.transpose(0, 2, 1)
+    network.detectors[0].SNR[:] = 100
+
+    _, errors, sky_localization, detected = fishermatrix.compute_fisher_errors(
+        network=network,
+        parameter_values=parameter_values,
+        fisher_parameters=["ra", "dec", "a", "b", "c", "d"],
+        sub_network_ids=[0],
+        n_workers=n_workers,
+    )
+
+    inverses = np.linalg.inv(network.detectors[0].fisher_matrix)
+    assert np.array_equal(detected, np.arange(n_signals))
+    assert np.allclose(errors, np.sqrt(np.diagonal(inverses, axis1=1, axis2=2)))
+    assert np.allclose(
+        sky_localization,
+        fishermatrix.sky_localization_area(
+            inverses, parameter_values["dec"].to_numpy(), 0, 1
         ),
-    }
\ No newline at end of file
+    )
+
+
+def test_compute_fisher_errors_detector_threshold():
+    rng = np.random.default_rng(1)
+    parameter_values = pd.DataFrame({"a": [0.0, 0.0]})
+    network = Network(
+        detector_ids=["ET", "ET"],
+        detection_SNR=(6.0, 8.0),
+        parameters=parameter_values,
+        fisher_parameters=["a", "b", "c"],
+        config="detectors.yaml",
+    )
+    for detector in network.detectors:
+        vectors = rng.normal(size=(2, 3, 3))
+        detector.fisher_matrix[:] = vectors @ vectors.transpose(0, 2, 1)
+    network.detectors[0].SNR[:] = [100, 100]
+    # below the single-detector threshold for the second signal
+    network.detectors[1].SNR[:] = [100, 5]
+
+    _, errors, _, _ = fishermatrix.compute_fisher_errors(
+        network=network,
+        parameter_values=parameter_values,
+        fisher_parameters=["a", "b", "c"],
+        sub_network_ids=[0, 1],
+    )
+
+    network_fisher_matrices = network.detectors[0].fisher_matrix.copy()
+    network_fisher_matrices[0] += network.detectors[1].fisher_matrix[0]
+    inverses = np.linalg.inv(network_fisher_matrices)
+    assert np.allclose(errors, np.sqrt(np.diagonal(inverses, axis1=1, axis2=2)))
+
+
+def test_compute_fisher_errors_all_detectors_below_threshold():
+    rng = np.random.default_rng(1)
+    parameter_values = pd.DataFrame({"a": [0.0, 0.0]})
+    network = Network(
+        detector_ids=["ET", "ET", "ET"],
+        detection_SNR=(6.0, 8.0),
+        parameters=parameter_values,
+        fisher_parameters=["a", "b", "c"],
+        config="detectors.yaml",
+    )
+    for detector in network.detectors:
+        vectors = rng.normal(size=(2, 3, 3))
+        detector.fisher_matrix[:] = vectors @ vectors.transpose(0, 2, 1)
+        # the second signal has a network SNR of 8.66, but no detector above 6
+        detector.SNR[:] = [100, 5]
+
+    network_snr, errors, _, detected = fishermatrix.compute_fisher_errors(
+        network=network,
+        parameter_values=parameter_values,
+        fisher_parameters=["a", "b", "c"],
+        sub_network_ids=[0, 1, 2],
+    )
+
+    assert np.array_equal(detected, [0])
+    assert np.allclose(network_snr, [100 * np.sqrt(3)])
+    assert errors.shape == (1, 3)
+    assert np.all(np.isfinite(errors))
+
+
+def test_output_to_txt_file_ids(tmp_path):
+    parameter_values = pd.DataFrame(
+        {"id": ["GW1", "GW2"], "mass_1": [1.4, 30], "phase": [0, 1]}
+    )
+
+    fishermatrix.output_to_txt_file(
+        parameter_values=parameter_values,
+        network_snr=np.array([100.0, 12.5]),
+        parameter_errors=np.array([[0.1], [0.2]]),
+        sky_localization=None,
+        fisher_parameters=["mass_1"],
+        filename=str(tmp_path / "errors"),
+    )
+
+    assert (tmp_path / "errors.txt").read_text().splitlines() == [
+        "network_SNR id mass_1 phase err_mass_1",
+        "100.0 GW1 1.400E+00 0.000E+00 1.000E-01",
+        "12.5 GW2 3.000E+01 1.000E+00 2.000E-01",
+    ]
+
+
+def test_fisher_analysis_output_undetected(mocker):
+    parameter_values = pd.DataFrame(
+        [GW170817, {**GW170817, "luminosity_distance": 4000}]
+    )
+    fisher_parameters = list(GW170817.keys())
+
+    network = Network(
+        detector_ids=["ET"],
+        parameters=parameter_values,
+        fisher_parameters=fisher_parameters,
+        config="detectors.yaml",
+    )
+
+    # the second signal is below threshold, and its Fisher matrix is left at zero
+    network.detectors[0].fisher_matrix[0, :, :] = fishermatrix.FisherMatrix(
+        "gwfish_TaylorF2",
+        parameter_values.iloc[0],
+        fisher_parameters,
+        network.detectors[0],
+    )
+    network.detectors[0].SNR[:] = [100, 1]
+
+    mocker.patch.object(pd.DataFrame, "to_csv", autospec=True)
+    mocker.spy(fishermatrix, "invert_fisher_matrices")
+
+    analyze_and_save_to_txt(
+        network=network,
+        parameter_values=parameter_values,
+        fisher_parameters=fisher_parameters,
+        sub_network_ids_list=[[0]],
+        population_name="test",
+    )
+
+    save_data = pd.DataFrame.to_csv.call_args.args[0].to_numpy(dtype=float)
+
+    # only the detected signal is inverted
+    assert sum(
+        len(call.args[0])
+        for call in fishermatrix.invert_fisher_matrices.call_args_list
+    ) == 1
+
+    assert save_data.shape == (1, 22)
+    assert save_data[0, 0] == 100
+    assert save_data[0, 4] == 40
+    assert np.all(np.isfinite(save_data))
+
+
+def test_fisher_matrix_derivative_calls(mocker, gw170817_network):
+    parameter_values, fisher_parameters, network = gw170817_network
+
+    mocker.spy(fishermatrix, "derivative")
+
+    fishermatrix.FisherMatrix(
+        "gwfish_TaylorF2",
+        parameter_values.iloc[0],
+        fisher_parameters,
+        network.detectors[0],
+    )
+
+    # one derivative per parameter, not one per pair of parameters
+    calls = fishermatrix.derivative.call_args_list
+    assert len(calls) == len(fisher_parameters)
+    assert [call.args[2] for call in calls] == fisher_parameters
+
+
+def test_fisher_matrix_scalar_products(gw170817_network):
+    parameter_values, fisher_parameters, network = gw170817_network
+    detector = network.detectors[0]
+
+    fisher_matrix = fishermatrix.FisherMatrix(
+        "gwfish_TaylorF2", parameter_values.iloc[0], fisher_parameters, detector
+    )
+
+    derivs = [
+        fishermatrix.derivative(
+            "gwfish_TaylorF2", parameter_values.iloc[0], p, detector
+        )
+        for p in fisher_parameters
+    ]
+    expected = np.array(
+        [
+            [np.sum(aux.scalar_product(d1, d2, detector)) for d2 in derivs]
+            for d1 in derivs
+        ]
+    )
+
+    # compared relative to sqrt(F_ii F_jj), since some entries cancel out
+    scale = np.sqrt(np.outer(np.diag(expected), np.diag(expected)))
+
+    assert np.array_equal(fisher_matrix, fisher_matrix.T)
+    assert np.allclose(fisher_matrix / scale, expected / scale, rtol=0, atol=1e-12)